@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+###
+# Copyright (2016-2024) Hewlett Packard Enterprise Development LP
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# You may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+from ansible.module_utils.six.moves.urllib.request import getproxies, proxy_bypass
+
+HAS_URLLIB3 = True
+try:
+    import urllib3
+    from urllib3.util.retry import Retry
+except ImportError:
+    HAS_URLLIB3 = False
+
+POOL_MAXSIZE = 4
+RETRY_TOTAL = 3
+RETRY_BACKOFF_FACTOR = 0.3
+RETRY_STATUS_FORCELIST = [500, 502, 503, 504]
+
+_pools = {}
+
+
+def get_pool(baseuri):
+    # Returns the HTTPS connection pool shared by all the requests sent to
+    # baseuri from this process, so sockets are reused between requests.
+    # Returns None when https_proxy applies to baseuri, those requests are
+    # left to open_url which knows how to go through the proxy
+    if baseuri not in _pools:
+        url = urllib3.util.parse_url(baseuri)
+        if "https" in getproxies() and not proxy_bypass(url.host):
+            return None
+        # Certificates are not validated, as with validate_certs=False in
+        # RedfishUtils, so urllib3 would warn on every request
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        # Read timeouts are not retried, so a stalled iLO fails within the
+        # requested timeout instead of once per attempt
+        retries = Retry(
+            total=RETRY_TOTAL,
+            read=False,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUS_FORCELIST,
+            raise_on_status=False,
+        )
+        _pools[baseuri] = urllib3.HTTPSConnectionPool(
+            url.host, port=url.port, maxsize=POOL_MAXSIZE, block=False,
+            retries=retries, cert_reqs="CERT_NONE", assert_hostname=False)
+    return _pools[baseuri]
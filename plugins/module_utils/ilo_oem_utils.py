@@ -18,6 +18,7 @@
 
 from __future__ import absolute_import, division, print_function
 import os
+import importlib.util
 import tempfile
 import zipfile
 import shutil
@@ -35,13 +36,9 @@ __metaclass__ = type
 from ansible_collections.community.general.plugins.module_utils.redfish_utils import RedfishUtils
 from ansible.module_utils.basic import missing_required_lib
 
-HAS_REDFISH = True
-REDFISH_IMP_ERR = None
-try:
-    import redfish
-except ImportError as e:
-    REDFISH_IMP_ERR = traceback.format_exc()
-    HAS_REDFISH = False
+# redfish is only needed to upload components, so it is imported there
+# instead of on every module start
+HAS_REDFISH = importlib.util.find_spec("redfish") is not None
 
 HAS_PARAMIKO = True
 PARAMIKO_IMP_ERR = None
@@ -474,7 +471,6 @@ class iLOOemUtils(RedfishUtils):
             ret["ret"] = False
             return ret
 
-        etag = ""
         hpe = result["Oem"]["Hpe"]
         urltosend = "/cgi-bin/uploadFile"
 
@@ -487,6 +483,37 @@ class iLOOemUtils(RedfishUtils):
             ret["ret"] = False
             return ret
 
+        # A single session is shared by all the components, so the keep-alive
+        # connection is reused instead of logging in again for every upload
+        redfish_obj = self.redfish_login()
+        try:
+            return self.upload_components(redfish_obj, urltosend, filestoupload, options)
+        finally:
+            try:
+                redfish_obj.logout()
+            except Exception:
+                pass
+
+    def redfish_login(self):
+        import redfish
+
+        redfish_obj = redfish.RedfishClient(
+            base_url=self.root_uri, username=self.creds['user'], password=self.creds['pswd'])
+        redfish_obj.login()
+        return redfish_obj
+
+    def post_component(self, redfish_obj, urltosend, data):
+        session_key = redfish_obj.session_key
+        headers = {'Cookie': 'sessionKey=' + session_key,
+                   'X-Auth-Token': session_key, 'OData-Version': '4.0'}
+
+        return redfish_obj.post(
+            str(urltosend), [("sessionKey", session_key)] + data, args=None, headers=headers)
+
+    def upload_components(self, redfish_obj, urltosend, filestoupload, options):
+        ret = {}
+        etag = ""
+
         for item in filestoupload:
             ilo_upload_filename = item[0]
 
@@ -507,15 +534,6 @@ class iLOOemUtils(RedfishUtils):
 
             section_num = item[3]
 
-            user = self.creds['user']
-            pwd = self.creds['pswd']
-            baseurl = self.root_uri
-
-            redfish_obj = redfish.RedfishClient(
-                base_url=baseurl, username=user, password=pwd)
-            redfish_obj.login()
-            session_key = redfish_obj.session_key
-
             parameters = {
                 "UpdateRepository": options["update_repository"],
                 "UpdateTarget": options["update_target"],
@@ -524,8 +542,7 @@ class iLOOemUtils(RedfishUtils):
                 "UpdateRecoverySet": options["update_srs"],
             }
 
-            data = [("sessionKey", session_key),
-                    ("parameters", json.dumps(parameters))]
+            data = [("parameters", json.dumps(parameters))]
 
             if not compsigpath:
                 compsigpath = self.findcompsig(componentpath)
@@ -551,18 +568,23 @@ class iLOOemUtils(RedfishUtils):
                 ("file", (ilo_upload_filename, output, "application/octet-stream"))
             )
 
-            headers = {'Cookie': 'sessionKey=' + session_key,
-                       'X-Auth-Token': session_key, 'OData-Version': '4.0'}
-
-            args = None
+            results = self.post_component(redfish_obj, urltosend, data)
 
-            results = redfish_obj.post(
-                str(urltosend), data, args=args, headers=headers)
+            # The session may have expired while the previous component was
+            # processed, or the iLO may have been reset by an iLO firmware flash
+            if results.status == 401:
+                redfish_obj.login()
+                results = self.post_component(redfish_obj, urltosend, data)
 
             if results.status == 200:
                 ret["ret"] = True
                 ret["msg"] = "Uploaded successfully"
 
+            elif results.status == 401:
+                ret["msg"] = "Failed to authenticate with iLO while uploading %s" % ilo_upload_filename
+                ret["ret"] = False
+                return ret
+
             else:
                 ret["msg"] = "iLO UpdateService is busy. Please try again."
                 ret["ret"] = False
@@ -19,12 +19,184 @@ from __future__ import absolute_import, division, print_function
 
 __metaclass__ = type
 
+import hashlib
+import json
+from io import BytesIO
+import os
+import tempfile
+import time
+
 from ansible_collections.community.general.plugins.module_utils.redfish_utils import (
     RedfishUtils,
 )
+from ansible_collections.hpe.ilo.plugins.module_utils.ilo_http_pool import (
+    HAS_URLLIB3,
+    get_pool,
+)
+from ansible.module_utils.common.text.converters import to_bytes, to_native
+from ansible.module_utils.six.moves.urllib.error import HTTPError, URLError
+
+if HAS_URLLIB3:
+    import urllib3
+
+# Payload builder of each Manager command, with the resources it reads and patches
+MANAGER_COMMANDS = {
+    "SetTimeZone": {"payloads": "_time_zone_payloads", "reads": ["datetime"], "targets": ["datetime"]},
+    "SetDNSserver": {"payloads": "_dns_server_payloads", "reads": [], "targets": ["ethernet"]},
+    "SetDomainName": {"payloads": "_domain_name_payloads", "reads": ["ethernet"], "targets": ["ethernet"]},
+    "SetNTPServers": {"payloads": "_ntp_server_payloads", "reads": ["ethernet"], "targets": ["ethernet", "datetime"]},
+    "SetWINSReg": {"payloads": "_wins_registration_payloads", "reads": [], "targets": ["ethernet"]},
+}
+
+MANAGER_CACHE_DIR = tempfile.gettempdir()
+MANAGER_CACHE_TTL = 60
+
+
+def _manager_cache_path(root_uri):
+    # One file per iLO, so parallel tasks against different iLOs never
+    # overwrite each other's entries
+    key = hashlib.sha256(to_bytes(root_uri)).hexdigest()
+    return os.path.join(MANAGER_CACHE_DIR, "ilo_mgr_cache_%s.json" % key)
+
+
+def _read_manager_cache(path):
+    try:
+        # Only trust a cache file written by the current user
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        with open(path) as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    # Anything but an entry written by _write_manager_cache is a miss
+    if not isinstance(entry, dict):
+        return None
+    if not isinstance(entry.get("time"), (int, float)) or isinstance(entry["time"], bool):
+        return None
+    if not isinstance(entry.get("manager_uri"), str) or not isinstance(entry.get("manager_uris"), list):
+        return None
+    return entry
+
+
+def _write_manager_cache(path, entry):
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=MANAGER_CACHE_DIR)
+        with os.fdopen(fd, "w") as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _merge_payload(payload, fragment, command, owners, path=()):
+    # Later commands override the values set by earlier ones, as they did
+    # when every command was sent on its own. owners maps every property
+    # of the payload to the command whose value is sent
+    for key, value in fragment.items():
+        if isinstance(value, dict):
+            if not isinstance(payload.get(key), dict):
+                payload[key] = {}
+            _merge_payload(payload[key], value, command, owners, path + (key,))
+        else:
+            payload[key] = value
+            owners[path + (key,)] = command
+
+
+class _PoolResponse(object):
+    # Presents a urllib3 response like the open_url responses RedfishUtils
+    # reads, the body has already been decompressed by urllib3
+    def __init__(self, resp):
+        self.status = resp.status
+        self.code = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers.copy()
+        self.headers.discard("content-encoding")
+        self._body = BytesIO(resp.data)
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.status
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
 
 
 class iLORedfishUtils(RedfishUtils):
+    def __init__(self, creds, root_uri, timeout, module):
+        super().__init__(creds, root_uri, timeout, module)
+        # Requests go through a keep-alive pool when urllib3 is available and
+        # no proxy is needed, otherwise RedfishUtils opens a new connection
+        # for each request with open_url
+        self.pool = get_pool(root_uri) if HAS_URLLIB3 else None
+
+    def find_managers_resource_cached(self):
+        # Reuses the manager uri resolved by a recent task against the same iLO
+        # instead of walking the service root and Managers collection again
+        path = _manager_cache_path(self.root_uri)
+        entry = _read_manager_cache(path)
+        if entry and time.time() - entry["time"] < MANAGER_CACHE_TTL:
+            self.manager_uris = entry["manager_uris"]
+            self.manager_uri = entry["manager_uri"]
+            return {"ret": True, "cached": True}
+
+        response = self._find_managers_resource()
+        if not response["ret"]:
+            return response
+
+        _write_manager_cache(path, {
+            "time": time.time(),
+            "manager_uri": self.manager_uri,
+            "manager_uris": self.manager_uris,
+        })
+        return response
+
+    def invalidate_manager_cache(self):
+        try:
+            os.remove(_manager_cache_path(self.root_uri))
+        except OSError:
+            pass
+
+    def _request(self, uri, **kwargs):
+        # Transport used by the RedfishUtils requests. Sends them over the
+        # keep-alive pool when it can honour the request options, so the
+        # upstream request methods and their error handling are unchanged
+        validate_certs = kwargs.get("validate_certs", getattr(self, "validate_certs", False))
+        ca_path = kwargs.get("ca_path", getattr(self, "ca_path", None))
+        ciphers = kwargs.get("ciphers", getattr(self, "ciphers", None))
+        follow_redirects = kwargs.get("follow_redirects", "all")
+        if self.pool is None or validate_certs or ca_path or ciphers or follow_redirects != "all":
+            return super()._request(uri, **kwargs)
+
+        data = kwargs.get("data")
+        method = kwargs.get("method") or ("POST" if data else "GET")
+        headers = dict(kwargs.get("headers") or {})
+        if kwargs.get("force_basic_auth") and kwargs.get("url_username"):
+            headers.update(urllib3.make_headers(basic_auth="%s:%s" % (
+                kwargs["url_username"], kwargs.get("url_password") or "")))
+        try:
+            resp = self.pool.urlopen(
+                method, urllib3.util.parse_url(uri).request_uri, body=data,
+                headers=headers, timeout=kwargs.get("timeout", self.timeout),
+                redirect=True)
+        except urllib3.exceptions.HostChangedError:
+            # Redirects within the iLO are followed by the pool, open_url
+            # follows the ones to other hosts
+            return super()._request(uri, **kwargs)
+        except urllib3.exceptions.HTTPError as e:
+            raise URLError(to_native(e))
+
+        response = _PoolResponse(resp)
+        if response.status >= 400:
+            raise HTTPError(uri, response.status, resp.reason, response.headers, BytesIO(resp.data))
+        return response, dict((k.lower(), v) for (k, v) in response.headers.items())
+
     def get_ilo_sessions(self):
         result = {}
         # listing all users has always been slower than other operations, why?
@@ -68,175 +240,167 @@ class iLORedfishUtils(RedfishUtils):
         return result
 
     def set_ntp_server(self, mgr_attributes):
-        result = {}
-        setkey = mgr_attributes['mgr_attr_name']
+        return self.set_manager_attributes(["SetNTPServers"], mgr_attributes)["SetNTPServers"]
 
-        nic_info = self.get_manager_ethernet_uri()
-        ethuri = nic_info["nic_addr"]
+    def set_time_zone(self, attr):
+        return self.set_manager_attributes(["SetTimeZone"], attr)["SetTimeZone"]
 
-        response = self.get_request(self.root_uri + ethuri)
-        if not response['ret']:
-            return response
-        result['ret'] = True
-        data = response['data']
-        payload = {"DHCPv4": {
-            "UseNTPServers": ""
-        }}
-
-        if data["DHCPv4"]["UseNTPServers"]:
-            payload["DHCPv4"]["UseNTPServers"] = False
-            res_dhv4 = self.patch_request(self.root_uri + ethuri, payload)
-            if not res_dhv4['ret']:
-                return res_dhv4
-
-        payload = {"DHCPv6": {
-            "UseNTPServers": ""
-        }}
-
-        if data["DHCPv6"]["UseNTPServers"]:
-            payload["DHCPv6"]["UseNTPServers"] = False
-            res_dhv6 = self.patch_request(self.root_uri + ethuri, payload)
-            if not res_dhv6['ret']:
-                return res_dhv6
-
-        datetime_uri = self.manager_uri + "DateTime"
-
-        listofips = mgr_attributes['mgr_attr_value'].split(" ")
-        if len(listofips) > 2:
-            return {'ret': False, 'changed': False, 'msg': "More than 2 NTP Servers mentioned"}
+    def set_dns_server(self, attr):
+        return self.set_manager_attributes(["SetDNSserver"], attr)["SetDNSserver"]
 
-        ntp_list = []
-        for ips in listofips:
-            ntp_list.append(ips)
+    def set_domain_name(self, attr):
+        return self.set_manager_attributes(["SetDomainName"], attr)["SetDomainName"]
+
+    def set_wins_registration(self, mgrattr):
+        return self.set_manager_attributes(["SetWINSReg"], mgrattr)["SetWINSReg"]
+
+    @staticmethod
+    def _dhcp_payload(eth_data, dhcp_key):
+        # DHCP supplied values have to be disabled before static ones are accepted
+        payload = {}
+        for dhcp in ["DHCPv4", "DHCPv6"]:
+            if eth_data[dhcp][dhcp_key]:
+                payload[dhcp] = {dhcp_key: False}
+        return payload
+
+    def _ntp_server_payloads(self, key, value, data):
+        ntp_list = value.split(" ")
+        if len(ntp_list) > 2:
+            return {'ret': False, 'changed': False, 'msg': "More than 2 NTP Servers mentioned"}
 
         while len(ntp_list) < 2:
             ntp_list.append("0.0.0.0")
 
-        payload = {setkey: ntp_list}
-
-        response1 = self.patch_request(self.root_uri + datetime_uri, payload)
-        if not response1['ret']:
-            return response1
-
-        return {'ret': True, 'changed': True, 'msg': "Modified %s" % mgr_attributes['mgr_attr_name']}
-
-    def set_time_zone(self, attr):
-        key = attr["mgr_attr_name"]
-
-        uri = self.manager_uri + "DateTime/"
-        response = self.get_request(self.root_uri + uri)
-        if not response["ret"]:
-            return response
-
-        data = response["data"]
+        return {
+            "ret": True,
+            "ethernet": self._dhcp_payload(data["ethernet"], "UseNTPServers"),
+            "datetime": {key: ntp_list},
+        }
 
-        if key not in data:
+    def _time_zone_payloads(self, key, value, data):
+        if key not in data["datetime"]:
             return {"ret": False, "changed": False, "msg": "Key %s not found" % key}
 
-        timezones = data["TimeZoneList"]
         index = ""
-        for tz in timezones:
-            if attr["mgr_attr_value"] in tz["Name"]:
+        for tz in data["datetime"]["TimeZoneList"]:
+            if value in tz["Name"]:
                 index = tz["Index"]
                 break
 
-        payload = {key: {"Index": index}}
-        response = self.patch_request(self.root_uri + uri, payload)
-        if not response["ret"]:
-            return response
-
-        return {
-            "ret": True,
-            "changed": True,
-            "msg": "Modified %s" % attr["mgr_attr_name"],
-        }
-
-    def set_dns_server(self, attr):
-        key = attr['mgr_attr_name']
-        nic_info = self.get_manager_ethernet_uri()
-        uri = nic_info["nic_addr"]
+        return {"ret": True, "datetime": {key: {"Index": index}}}
 
-        listofips = attr['mgr_attr_value'].split(" ")
-        if len(listofips) > 3:
+    def _dns_server_payloads(self, key, value, data):
+        dns_list = value.split(" ")
+        if len(dns_list) > 3:
             return {'ret': False, 'changed': False, 'msg': "More than 3 DNS Servers mentioned"}
 
-        dns_list = []
-        for ips in listofips:
-            dns_list.append(ips)
-
         while len(dns_list) < 3:
             dns_list.append("0.0.0.0")
 
-        payload = {
-            "Oem": {
-                "Hpe": {
-                    "IPv4": {
-                        key: dns_list
-                    }
+        return {"ret": True, "ethernet": {"Oem": {"Hpe": {"IPv4": {key: dns_list}}}}}
+
+    def _domain_name_payloads(self, key, value, data):
+        payload = self._dhcp_payload(data["ethernet"], "UseDomainName")
+        payload["Oem"] = {"Hpe": {key: value}}
+        return {"ret": True, "ethernet": payload}
+
+    def _wins_registration_payloads(self, key, value, data):
+        return {"ret": True, "ethernet": {"Oem": {"Hpe": {"IPv4": {key: False}}}}}
+
+    def set_manager_attributes(self, command_list, mgr_attributes):
+        # Applies Manager commands in the given order, with one PATCH per
+        # target resource however many commands are given, and returns the
+        # result of each command
+        key = mgr_attributes["mgr_attr_name"]
+        value = mgr_attributes["mgr_attr_value"]
+
+        results = {}
+        commands = []
+        for command in command_list:
+            if command in results or command in commands:
+                continue
+            if command not in MANAGER_COMMANDS:
+                results[command] = {"ret": False, "changed": False, "msg": "Invalid Command: %s" % command}
+            else:
+                commands.append(command)
+
+        targets = []
+        reads = []
+        for command in commands:
+            for resource in MANAGER_COMMANDS[command]["targets"]:
+                if resource not in targets:
+                    targets.append(resource)
+            for resource in MANAGER_COMMANDS[command]["reads"]:
+                if resource not in reads:
+                    reads.append(resource)
+
+        # Resources the commands depend on, or the error met fetching them
+        uris = {"datetime": self.manager_uri + "DateTime/"}
+        data = {}
+        errors = {}
+        if "ethernet" in targets:
+            nic_info = self.get_manager_ethernet_uri()
+            if nic_info.get("nic_addr"):
+                uris["ethernet"] = nic_info["nic_addr"]
+                # The interface resource comes along with its uri
+                data["ethernet"] = nic_info["ethernet_setting"]
+            elif nic_info.get("ret") is False:
+                # A failed GET is kept as is, so its 'status' is kept
+                errors["ethernet"] = nic_info
+            else:
+                errors["ethernet"] = {"ret": False, "changed": False, "msg": "Manager EthernetInterface not found"}
+
+        if "datetime" in reads:
+            response = self.get_request(self.root_uri + uris["datetime"])
+            if response["ret"]:
+                data["datetime"] = response["data"]
+            else:
+                errors["datetime"] = response
+
+        # Every payload is built before anything is sent, so a command with
+        # invalid input leaves the iLO untouched
+        fragments = {}
+        for command in commands:
+            needed = MANAGER_COMMANDS[command]["targets"] + MANAGER_COMMANDS[command]["reads"]
+            failed = [errors[resource] for resource in needed if resource in errors]
+            if failed:
+                results[command] = failed[0]
+                continue
+            response = getattr(self, MANAGER_COMMANDS[command]["payloads"])(key, value, data)
+            if not response["ret"]:
+                results[command] = response
+            else:
+                fragments[command] = response
+
+        # The interface is patched first, static NTP servers are only
+        # accepted once DHCP supplied NTP servers are disabled. A command
+        # whose interface changes failed is left out of the DateTime PATCH
+        applied = set()
+        for resource in ["ethernet", "datetime"]:
+            payload = {}
+            owners = {}
+            for command in fragments:
+                if command not in results and fragments[command].get(resource):
+                    _merge_payload(payload, fragments[command][resource], command, owners)
+            if not payload:
+                continue
+            response = self.patch_request(self.root_uri + uris[resource], payload)
+            for command in set(owners.values()):
+                if response["ret"]:
+                    applied.add(command)
+                else:
+                    results[command] = response
+
+        for command in fragments:
+            if command in results:
+                continue
+            if command in applied:
+                results[command] = {"ret": True, "changed": True, "msg": "Modified %s" % key}
+            else:
+                results[command] = {
+                    "ret": True,
+                    "changed": False,
+                    "msg": "%s was overridden by a later command" % key,
                 }
-            }
-        }
-
-        response = self.patch_request(self.root_uri + uri, payload)
-        if not response['ret']:
-            return response
-
-        return {'ret': True, 'changed': True, 'msg': "Modified %s" % attr['mgr_attr_name']}
-
-    def set_domain_name(self, attr):
-        key = attr["mgr_attr_name"]
-
-        nic_info = self.get_manager_ethernet_uri()
-        ethuri = nic_info["nic_addr"]
-
-        response = self.get_request(self.root_uri + ethuri)
-        if not response["ret"]:
-            return response
-
-        data = response["data"]
-
-        payload = {"DHCPv4": {"UseDomainName": ""}}
-
-        if data["DHCPv4"]["UseDomainName"]:
-            payload["DHCPv4"]["UseDomainName"] = False
-            res_dhv4 = self.patch_request(self.root_uri + ethuri, payload)
-            if not res_dhv4["ret"]:
-                return res_dhv4
-
-        payload = {"DHCPv6": {"UseDomainName": ""}}
-
-        if data["DHCPv6"]["UseDomainName"]:
-            payload["DHCPv6"]["UseDomainName"] = False
-            res_dhv6 = self.patch_request(self.root_uri + ethuri, payload)
-            if not res_dhv6["ret"]:
-                return res_dhv6
 
-        domain_name = attr["mgr_attr_value"]
-
-        payload = {"Oem": {"Hpe": {key: domain_name}}}
-
-        response = self.patch_request(self.root_uri + ethuri, payload)
-        if not response["ret"]:
-            return response
-        return {
-            "ret": True,
-            "changed": True,
-            "msg": "Modified %s" % attr["mgr_attr_name"],
-        }
-
-    def set_wins_registration(self, mgrattr):
-        Key = mgrattr["mgr_attr_name"]
-
-        nic_info = self.get_manager_ethernet_uri()
-        ethuri = nic_info["nic_addr"]
-
-        payload = {"Oem": {"Hpe": {"IPv4": {Key: False}}}}
-
-        response = self.patch_request(self.root_uri + ethuri, payload)
-        if not response["ret"]:
-            return response
-        return {
-            "ret": True,
-            "changed": True,
-            "msg": "Modified %s" % mgrattr["mgr_attr_name"],
-        }
+        return results
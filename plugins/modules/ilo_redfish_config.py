@@ -39,6 +39,12 @@ options:
     required: true
     description:
       - List of commands to execute on iLO.
+      - When several commands are given, their changes are combined and
+        sent with a single request per Manager resource. Each command still
+        reports its own result.
+      - Commands setting the same property of a resource are applied in
+        the given order, the last one wins and the earlier ones report
+        C(changed=false).
     type: list
     elements: str
   baseuri:
@@ -61,6 +67,9 @@ options:
   timeout:
     description:
       - Timeout in seconds for URL requests to iLO controller.
+      - Applies to each request, a request that stalls fails after C(timeout)
+        and is not retried. Failed connection attempts, and 5xx responses to
+        GET, are retried up to 3 times.
     default: 10
     type: int
   attribute_name:
@@ -73,6 +82,15 @@ options:
     description:
       - Value of the attribute to be configured.
     type: str
+notes:
+  - When the urllib3 library is available, requests to iLO reuse one
+    persistent HTTPS connection instead of going through Ansible's open_url.
+    Certificates are not validated, as before. Redirects to other hosts,
+    and any baseuri that https_proxy applies to, still go through open_url.
+    So does every request that validates certificates or sets a CA path
+    or ciphers.
+  - The module talks to a single iLO per task. When configuring many iLOs,
+    raise C(forks) and use the C(free) strategy so hosts are handled in parallel.
 author:
     - "Bhavya B (@bhavya06)"
 """
@@ -104,23 +122,46 @@ msg:
     returned: always
     type: str
     sample: "Action was successful"
+ilo_redfish_config:
+    description:
+      - Result of each command, keyed by command name.
+      - Each result holds C(ret), C(changed) and C(msg), and C(status) when
+        a request to iLO failed.
+    returned: always
+    type: dict
+    sample: {
+        "SetDNSserver": {"ret": true, "changed": true, "msg": "Modified DNSServers"}
+    }
 """
 
 CATEGORY_COMMANDS_ALL = {
-    "Manager": [
+    "Manager": frozenset([
         "SetTimeZone",
         "SetDNSserver",
         "SetDomainName",
         "SetNTPServers",
         "SetWINSReg",
-    ]
+    ])
 }
 
-from ansible_collections.community.general.plugins.module_utils.ilo_redfish_utils import (
+from ansible_collections.hpe.ilo.plugins.module_utils.ilo_redfish_utils import (
     iLORedfishUtils,
 )
 from ansible.module_utils.basic import AnsibleModule
-from ansible.module_utils._text import to_native
+
+
+def run_manager_commands(rf_utils, command_list, mgr_attributes):
+    result = {}
+    changed = False
+
+    # All the commands are coalesced into one PATCH per Manager resource
+    results = rf_utils.set_manager_attributes(command_list, mgr_attributes)
+    for command in command_list:
+        result[command] = results[command]
+        if "changed" in result[command]:
+            changed |= result[command]["changed"]
+
+    return result, changed
 
 
 def main():
@@ -168,35 +209,32 @@ def main():
     }
     changed = False
 
-    offending = [
-        cmd for cmd in command_list if cmd not in CATEGORY_COMMANDS_ALL[category]
-    ]
+    offending = set(command_list) - CATEGORY_COMMANDS_ALL[category]
 
     if offending:
         module.fail_json(
-            msg=to_native(
-                "Invalid Command(s): '%s'. Allowed Commands = %s"
-                % (offending, CATEGORY_COMMANDS_ALL[category])
-            )
+            msg="Invalid Command(s): '%s'. Allowed Commands = %s"
+            % (sorted(offending), sorted(CATEGORY_COMMANDS_ALL[category]))
         )
 
     if category == "Manager":
-        resource = rf_utils._find_managers_resource()
+        resource = rf_utils.find_managers_resource_cached()
         if not resource["ret"]:
-            module.fail_json(msg=to_native(resource["msg"]))
-
-        dispatch = dict(
-            SetTimeZone=rf_utils.set_time_zone,
-            SetDNSserver=rf_utils.set_dns_server,
-            SetDomainName=rf_utils.set_domain_name,
-            SetNTPServers=rf_utils.set_ntp_server,
-            SetWINSReg=rf_utils.set_wins_registration,
-        )
+            module.fail_json(msg=resource["msg"])
+
+        result, changed = run_manager_commands(rf_utils, command_list, mgr_attributes)
+
+        # A stale cached manager uri shows up as a missing resource,
+        # discover the manager again and retry once
+        if resource.get("cached") and any(
+            res.get("status") in (404, 410) for res in result.values()
+        ):
+            rf_utils.invalidate_manager_cache()
+            resource = rf_utils.find_managers_resource_cached()
+            if not resource["ret"]:
+                module.fail_json(msg=resource["msg"])
 
-        for command in command_list:
-            result[command] = dispatch[command](mgr_attributes)
-            if "changed" in result[command]:
-                changed |= result[command]["changed"]
+            result, changed = run_manager_commands(rf_utils, command_list, mgr_attributes)
 
     module.exit_json(ilo_redfish_config=result, changed=changed)
 